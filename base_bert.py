@@ -165,6 +165,13 @@ class BertPreTrainedModel(nn.Module):
       # print(old_key, new_key)
       state_dict[new_key] = state_dict.pop(old_key)
 
+    # fuse the separate query/key/value projections into the single qkv projection
+    for key in list(state_dict.keys()):
+      if ".self_attention.query." in key:
+        prefix, suffix = key.split(".self_attention.query.")
+        qkv = [state_dict.pop(f"{prefix}.self_attention.{x}.{suffix}") for x in ("query", "key", "value")]
+        state_dict[f"{prefix}.self_attention.qkv.{suffix}"] = torch.cat(qkv, dim=0)
+
     # copy state_dict so _load_from_state_dict can modify it
     metadata = getattr(state_dict, "_metadata", None)
     state_dict = state_dict.copy()
@@ -1,13 +1,28 @@
 from typing import Dict, List, Optional, Union, Tuple, Callable
 import math
+import inspect
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
+from functools import partial
 from base_bert import BertPreTrainedModel
 from utils import *
 import pdb
 
 
+def add_dropout_layer_norm(input, output, p, training, ln_weight, ln_bias, eps):
+  # residual add + dropout + layer norm in one function so that it can be compiled into a single kernel
+  return F.layer_norm(input + F.dropout(output, p, training), ln_weight.shape, ln_weight, ln_bias, eps)
+
+
+# compiled once with dynamic shapes so that every sequence length shares the kernel, used for cuda tensors
+fused_add_dropout_layer_norm = torch.compile(add_dropout_layer_norm, dynamic=True) if hasattr(torch, 'compile') else None
+
+# checkpoint_sequential only takes use_reentrant from torch 2.0 on, older versions run it in reentrant mode
+checkpoint_kwargs = {'use_reentrant': False} if 'use_reentrant' in inspect.signature(torch.utils.checkpoint.checkpoint_sequential).parameters else {}
+
+
 class BertSelfAttention(nn.Module):
   def __init__(self, config):
     super().__init__()
@@ -15,39 +30,53 @@ class BertSelfAttention(nn.Module):
     self.num_attention_heads = config.num_attention_heads
     self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
     self.all_head_size = self.num_attention_heads * self.attention_head_size
+    self._inv_sqrt_dk = 1.0 / math.sqrt(self.attention_head_size)
 
-    # initialize the linear transformation layers for key, value, query
-    self.query = nn.Linear(config.hidden_size, self.all_head_size)
-    self.key = nn.Linear(config.hidden_size, self.all_head_size)
-    self.value = nn.Linear(config.hidden_size, self.all_head_size)
+    # initialize the fused linear transformation layer for query, key, value
+    # the pretrained query/key/value weights are concatenated into it in from_pretrained
+    self.qkv = nn.Linear(config.hidden_size, 3 * self.all_head_size)
     self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
-  def transform(self, x, linear_layer):
-    # split the hidden states to num_attention_heads for multi-head attention
-    # hidden_size = self.num_attention_heads * self.attention_head_size
+  def transform(self, x):
+    # project the hidden states once and split them to query, key, value of num_attention_heads
     # x [batch_size, seq_len, hidden_size]
+    # -> [batch_size, seq_len, 3, num_attention_heads, attention_head_size]
     bs, seq_len = x.shape[:2]
-    proj = linear_layer(x)
-    proj = proj.view(bs, seq_len, self.num_attention_heads, self.attention_head_size)
-    proj = proj.transpose(1, 2)
+    proj = self.qkv(x)
+    proj = proj.view(bs, seq_len, 3, self.num_attention_heads, self.attention_head_size)
     return proj
 
   def attention(self, key, query, value, attention_mask):
-    # each key, query, value is of [bs, self.num_attention_heads, seq_len, self.attention_head_size]
+    # each key, query, value is of [bs, seq_len, self.num_attention_heads, self.attention_head_size]
+    # the output keeps this layout so that the heads can be concatenated without a transpose
     # eq (1) of https://arxiv.org/pdf/1706.03762.pdf
-    attn_score = torch.matmul(query, key.transpose(-1,-2)) / math.sqrt(key.size(-1))
-    attn_score = attn_score.masked_fill_(attention_mask==-10000.0, value=-10000.0)
+    if hasattr(F, 'scaled_dot_product_attention'):
+      # fused kernel, never materializes the [bs, num_heads, seq_len, seq_len] score matrix
+      # attention_mask is the additive extended mask (-10000 on padding)
+      # it works on [bs, num_heads, seq_len, head_size], the transposes are views
+      dropout_p = self.dropout.p if self.training else 0.0
+      attn_value = F.scaled_dot_product_attention(query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2),
+                                                  attn_mask=attention_mask.to(query.dtype), dropout_p=dropout_p)
+      return attn_value.transpose(1, 2)
+    # fallback for torch < 2.0
+    # scale the [seq_len, head_size] query rather than the [seq_len, seq_len] scores
+    query = query * self._inv_sqrt_dk
+    attn_score = torch.einsum('bshd,bthd->bhst', query, key)
+    # the extended mask is additive, 0 for real tokens and -10000 for padding
+    attn_score = attn_score + attention_mask
     softmax_score = F.softmax(attn_score, dim=-1)
-    # softmax_score = self.dropout(softmax_score)
-    attn_score = torch.matmul(softmax_score, value)  # size(value) == size(attn_score)
-    return attn_score
+    softmax_score = self.dropout(softmax_score)
+    attn_value = torch.einsum('bhst,bthd->bshd', softmax_score, value)
+    return attn_value
 
   def forward(self, hidden_states, attention_mask):
-    key_layer = self.transform(hidden_states, self.key)
-    value_layer = self.transform(hidden_states, self.value)
-    query_layer = self.transform(hidden_states, self.query)
+    bs, seq_len = hidden_states.shape[:2]
+    qkv_layer = self.transform(hidden_states)
+    query_layer, key_layer, value_layer = qkv_layer.unbind(dim=2)
     attn_value = self.attention(key_layer, query_layer, value_layer, attention_mask)
-    return attn_value
+    # concat attention heads
+    # [bs, seq_len, num_heads, head_size] -> [bs, seq_len, d_model], a view when the kernel wrote this layout
+    return attn_value.reshape(bs, seq_len, self.all_head_size)
 
 
 class BertLayer(nn.Module):
@@ -65,6 +94,8 @@ class BertLayer(nn.Module):
     self.out_dense = nn.Linear(config.intermediate_size, config.hidden_size)
     self.out_layer_norm = nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps)
     self.out_dropout = nn.Dropout(config.hidden_dropout_prob)
+    # extended attention mask, set by BertModel.encode before each forward
+    self._attn_mask = None
 
   def add_norm(self, input, output, dense_layer, dropout, ln_layer):
     """
@@ -73,15 +104,18 @@ class BertLayer(nn.Module):
     dense_layer, dropout: the sublayer
     ln_layer: layer norm that takes input+sublayer(output)
     """
-    return ln_layer(input + dropout(dense_layer(output)))
-
-  def forward(self, hidden_states, attention_mask):
-    # multi-head attention
-    bs, seq_len = hidden_states.size()[:2]
+    output = dense_layer(output)
+    if fused_add_dropout_layer_norm is not None and output.is_cuda:
+      return fused_add_dropout_layer_norm(input, output, dropout.p, self.training, ln_layer.weight, ln_layer.bias, ln_layer.eps)
+    return ln_layer(input + dropout(output))
+
+  def forward(self, hidden_states, attention_mask=None):
+    # the extended attention mask is either passed or set on the layer by BertModel.encode
+    if attention_mask is None:
+      attention_mask = self._attn_mask
+    assert attention_mask is not None, "BertLayer needs the extended attention mask, pass attention_mask or call it through BertModel.encode"
+    # multi-head attention, with the heads already concatenated to [bs, seq_len, d_model]
     attn_output = self.self_attention(hidden_states, attention_mask)
-    # concat attention heads
-    # [bs, num_heads, seq_len, hidn_dim] -> [bs, seq_len, num_heads, hidn_dim] -> [bs, seq_len, d_model]
-    attn_output = attn_output.transpose(1,2).reshape(bs, seq_len, -1)
     # add-norm layer
     norm_output = self.add_norm(hidden_states, attn_output, self.attention_dense, self.attention_dropout, self.attention_layer_norm)
     # feed forward
@@ -108,11 +142,12 @@ class BertModel(BertPreTrainedModel):
     self.register_buffer('position_ids', position_ids)
 
     # bert encoder
-    self.bert_layers = nn.ModuleList([BertLayer(config) for _ in range(config.num_hidden_layers)])
+    self.bert_layers = nn.Sequential(*[BertLayer(config) for _ in range(config.num_hidden_layers)])
 
     # for [CLS] token
     self.pooler_dense = nn.Linear(config.hidden_size, config.hidden_size)
-    self.pooler_af = nn.Tanh()
+    # in-place, the pooler_dense output is not needed by its backward
+    self.pooler_af = torch.tanh_
 
     self.init_weights()
 
@@ -124,13 +159,12 @@ class BertModel(BertPreTrainedModel):
     inputs_embeds = self.word_embedding(input_ids)
 
     # get position index and position embedding
-    # todo
-    # pos_embeds = self.pos_embedding(self.position_ids)
-    pos_embeds = self.pos_embedding(torch.arange(seq_length, device=input_ids.device).expand(input_shape))
+    # [1, seq_len, hidden_size], broadcast over the batch
+    pos_embeds = self.pos_embedding(self.position_ids[:, :seq_length])
 
-    # get token type ids, since we are not consider token type, just a placeholder
-    tk_type_ids = torch.zeros(input_shape, dtype=torch.long, device=input_ids.device)
-    tk_type_embeds = self.tk_type_embedding(tk_type_ids)
+    # since we do not consider token type, every token has type 0
+    # use its embedding row directly instead of looking up a zeros tensor, broadcast over the batch
+    tk_type_embeds = self.tk_type_embedding.weight[0]
 
     # add three embeddings together
     embeds = inputs_embeds + tk_type_embeds + pos_embeds
@@ -146,8 +180,19 @@ class BertModel(BertPreTrainedModel):
     extended_attention_mask: torch.Tensor = get_extended_attention_mask(attention_mask, self.dtype)
 
     # pass the hidden states through the encoder layers
-    for i, layer_module in enumerate(self.bert_layers):
-      hidden_states = layer_module(hidden_states, extended_attention_mask)
+    if self.config.gradient_checkpointing and self.training:
+      # do not keep the layer activations, recompute them segment by segment during backward
+      # the mask is bound to each layer so that the recomputation uses the mask of this forward
+      layers = [partial(layer_module, attention_mask=extended_attention_mask) for layer_module in self.bert_layers]
+      hidden_states = torch.utils.checkpoint.checkpoint_sequential(layers, 4, hidden_states, **checkpoint_kwargs)
+    else:
+      # the layers read the mask from an attribute so that they only take the hidden states
+      for layer_module in self.bert_layers:
+        layer_module._attn_mask = extended_attention_mask
+      hidden_states = self.bert_layers(hidden_states)
+      # do not keep a reference to the mask after the forward
+      for layer_module in self.bert_layers:
+        layer_module._attn_mask = None
 
     return hidden_states
 
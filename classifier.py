@@ -1,10 +1,10 @@
 from collections import defaultdict as ddict 
-import time, random, numpy as np, argparse, sys, re, os
+import time, random, bisect, tempfile, numpy as np, argparse, sys, re, os
 from types import SimpleNamespace 
 
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from sklearn.metrics import classification_report, f1_score, recall_score, accuracy_score
 
 # change it with respect to the original model
@@ -14,17 +14,33 @@ from torch.optim import AdamW
 import pickle
 
 import wandb  # show training curve
-wandb.init(project="minbert-assignment")
 
 # fix the random seed
-def seed_everything(seed=11747):
+def seed_everything(seed=11747, deterministic=False):
 	random.seed(seed)
 	np.random.seed(seed)
 	torch.manual_seed(seed)
 	torch.cuda.manual_seed(seed)
 	torch.cuda.manual_seed_all(seed)
-	torch.backends.cudnn.benchmark = False
-	torch.backends.cudnn.deterministic = True
+	if deterministic:
+		torch.backends.cudnn.benchmark = False
+		torch.backends.cudnn.deterministic = True
+	else:
+		# let cudnn autotune and use tf32 matmuls on ampere+, runs are then only approximately reproducible
+		torch.backends.cudnn.benchmark = True
+		torch.backends.cudnn.deterministic = False
+		torch.backends.cuda.matmul.allow_tf32 = True
+		torch.backends.cudnn.allow_tf32 = True
+
+
+# run the forward pass in bfloat16 mixed precision, see use_native_bf16
+def autocast(use_bf16):
+	return torch.autocast('cuda', dtype=torch.bfloat16, enabled=use_bf16)
+
+
+# bf16 autocast only pays off on GPUs with native bf16 (ampere+), decided once after the device is chosen
+def use_native_bf16(use_cuda):
+	return use_cuda and torch.cuda.get_device_capability()[0] >= 8
 
 
 class BertSentClassifier(torch.nn.Module):
@@ -43,7 +59,8 @@ class BertSentClassifier(torch.nn.Module):
 		pooled_output = self.dropout(pooled_output)
 		pooled_output = self.ln_layer(pooled_output)
 		# adjust the model paramters depending on whether we are pre-training or fine-tuning BERT
-		return F.log_softmax(pooled_output, dim=-1)
+		# return the raw logits, F.cross_entropy applies the log-softmax
+		return pooled_output
 
 class PretrainedBert(torch.nn.Module):
 	def __init__(self, config, pretrained_weights):
@@ -60,7 +77,7 @@ class PretrainedBert(torch.nn.Module):
 		pooled_output 			= 	self.bert(input_ids= input_ids, attention_mask= attention_mask)['pooler_output']
 		pooled_output 			= 	self.dropout(pooled_output)
 		logits 				= 	self.classifier(pooled_output)
-		return F.log_softmax(logits, dim=1)
+		return logits
 
 
 # create a custom Dataset Class to be used for the dataloader
@@ -68,65 +85,147 @@ class BertDataset(Dataset):
 	def __init__(self, dataset, args):
 		self.dataset		= dataset
 		self.p 				= args
-		self.tokenizer		= BertTokenizer.from_pretrained('bert-base-uncased')
+		self.lengths		= [int(x[3].sum()) for x in dataset] # number of tokens
 
 		
 	def __len__(self):
 		return len(self.dataset)
 
 	def __getitem__(self, idx):
-		ele = self.dataset[idx]
-		return ele
+		sent, label, token_ids, attention_mask = self.dataset[idx]
+		# zero-copy views of the memory-mapped rows
+		return torch.from_numpy(token_ids), torch.from_numpy(attention_mask), label, sent, idx
 
 	def pad_data(self, data):
 
-		sents 			= 	[x[0] for x in data]
-		labels 			= 	[x[1] for x in data]
-		encoding	 	= 	self.tokenizer(sents, return_tensors='pt', padding=True, truncation=True)
-		token_ids 		=	torch.LongTensor(encoding['input_ids'])
-		attention_mask 	= 	torch.LongTensor(encoding['attention_mask'])
-		token_type_ids  =   torch.LongTensor(encoding['token_type_ids'])
-		labels 			= 	torch.LongTensor(labels)
-
-		return token_ids, token_type_ids, attention_mask, labels, sents
-
-	def collate_fn(self, all_data):
-		all_data.sort(key = lambda x: -len(x[2])) # sort by number of tokens
-
-		batches 		= []
-		num_batches 	= int(np.ceil(len(all_data) / self.p.batch_size))
-
-		for i in range(num_batches):
-			start_idx 	= i * self.p.batch_size
-			data 	   	= all_data[start_idx : start_idx + self.p.batch_size]
-
-			token_ids, token_type_ids, attention_mask, labels, sents = self.pad_data(data)
-			batches.append ({
-				'token_ids'			: token_ids,
-				'token_type_ids'	: token_type_ids,
-				'attention_mask'	: attention_mask,
-				'labels'			: labels,
-				'sents'				: sents,
-			})
+		# the rows are padded to the longest sentence of the corpus, cut them to the longest of the batch
+		seq_len 		= 	max(int(x[1].sum()) for x in data)
+		# with torch.compile, pad to multiples of 32 so only a few sequence lengths get compiled
+		if self.p.compile:
+			seq_len 		= 	-(-seq_len // 32) * 32
+		# slice the rows before stacking so only the kept columns are copied
+		token_ids 		=	torch.stack([x[0][:seq_len] for x in data]).long()
+		attention_mask 	= 	torch.stack([x[1][:seq_len] for x in data]).long()
+		if token_ids.size(1) < seq_len:
+			# the pad token id of bert-base-uncased is 0
+			token_ids 		= 	F.pad(token_ids, (0, seq_len - token_ids.size(1)))
+			attention_mask 	= 	F.pad(attention_mask, (0, seq_len - attention_mask.size(1)))
+		token_type_ids  =   torch.zeros_like(token_ids)
+		labels 			= 	torch.LongTensor([x[2] for x in data])
+		sents 			= 	[x[3] for x in data]
+		indices 		= 	[x[4] for x in data]
+
+		return token_ids, token_type_ids, attention_mask, labels, sents, indices
+
+	def collate_fn(self, data):
+		# the batch was already grouped by length in LengthGroupedBatchSampler
+		token_ids, token_type_ids, attention_mask, labels, sents, indices = self.pad_data(data)
+
+		return {
+			'token_ids'			: token_ids,
+			'token_type_ids'	: token_type_ids,
+			'attention_mask'	: attention_mask,
+			'labels'			: labels,
+			'sents'				: sents,
+			'indices'			: indices, # position in the dataset, to write predictions back in file order
+		}
+
+
+# yield batches of indices whose sentences have similar lengths to minimize padding
+class LengthGroupedBatchSampler(Sampler):
+	def __init__(self, lengths, batch_size, shuffle, buckets=(8, 16, 32, 64, 128, 192, 256, 384, 512)):
+		self.lengths 		= lengths
+		self.batch_size 	= batch_size
+		self.shuffle 		= shuffle
+
+		# group the indices by length bucket, up to max_position_embeddings so long cfimdb reviews are bucketed too
+		self.groups 		= ddict(list)
+		for idx, length in enumerate(lengths):
+			self.groups[bisect.bisect_left(buckets, length)].append(idx)
+
+	def __iter__(self):
+		if self.shuffle:
+			groups 			= [random.sample(indices, len(indices)) for indices in self.groups.values()]
+		else:
+			# without shuffling, a global sort by length gives the least padding
+			groups 			= [sorted(range(len(self.lengths)), key=lambda idx: self.lengths[idx])]
+
+		batches 			= []
+		for indices in groups:
+			batches.extend(indices[i : i + self.batch_size] for i in range(0, len(indices), self.batch_size))
+
+		if self.shuffle:
+			random.shuffle(batches)
+		return iter(batches)
 
-		return batches
-
-# create the data which is a list of (sentence, label, token for the labels)
+	def __len__(self):
+		if self.shuffle:
+			return sum(int(np.ceil(len(indices) / self.batch_size)) for indices in self.groups.values())
+		return int(np.ceil(len(self.lengths) / self.batch_size))
+
+# write an array to a .npy file atomically, a crashed or concurrent run never leaves a truncated cache
+def save_cache(path, array):
+	fd, tmp_path 	= tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.npy')
+	try:
+		with os.fdopen(fd, 'wb') as fp:
+			np.save(fp, array)
+		# mkstemp creates the file with mode 0600, give it the default permissions so the cache can be shared
+		umask 		= os.umask(0)
+		os.umask(umask)
+		os.chmod(tmp_path, 0o666 & ~umask)
+		os.replace(tmp_path, path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.unlink(tmp_path)
+		raise
+
+
+# create the data which is a list of (sentence, label, token ids, attention mask)
 def create_data(filename, flag='train'):
-	# how to specify the tokenizer
-	tokenizer 		= BertTokenizer.from_pretrained('bert-base-uncased')
 	num_labels  		= {}
-	data 			= []
+	sents 			= []
+	labels 			= []
 
 	with open(filename, 'r') as fp:
 		for line in fp:
 			label, org_sent 			= line.split(' ||| ')
 			sent 					= org_sent.lower().strip()
-			tokens 					= tokenizer.tokenize("[CLS] "+ sent+" [SEP]")
 			label 					= int(label.strip())
 			if label not in num_labels:
 				num_labels[label]		= len(num_labels)
-			data.append((sent, label, tokens))
+			sents.append(sent)
+			labels.append(label)
+
+	# tokenize the whole corpus once into padded int32 arrays, cached as .npy files next to the data file
+	# the cache name carries the tokenizer and truncation length it was built with
+	tokenizer_name 		= 'bert-base-uncased'
+	max_length 		= 512
+	cache_prefix 		= f"{filename}.{tokenizer_name}-{max_length}"
+	ids_file 		= f"{cache_prefix}.input_ids.npy"
+	mask_file 		= f"{cache_prefix}.attention_mask.npy"
+	token_ids 		= None
+	if all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(filename) for f in (ids_file, mask_file)):
+		try:
+			# copy-on-write memory maps, so that torch.from_numpy gets writable rows without reading the whole file
+			token_ids 		= np.load(ids_file, mmap_mode='c')
+			attention_mask 	= np.load(mask_file, mmap_mode='c')
+		except (OSError, ValueError):
+			# unreadable (e.g. another user's permissions) or corrupt cache, tokenize again
+			token_ids 		= None
+
+	if token_ids is None:
+		tokenizer 		= BertTokenizer.from_pretrained(tokenizer_name)
+		encoding 		= tokenizer(sents, padding=True, truncation=True, max_length=max_length, return_tensors='np')
+		token_ids 		= encoding['input_ids'].astype(np.int32)
+		attention_mask 		= encoding['attention_mask'].astype(np.int32)
+		try:
+			save_cache(ids_file, token_ids)
+			save_cache(mask_file, attention_mask)
+		except OSError as err:
+			# e.g. a read-only data directory, the in-memory arrays are used as they are
+			print(f"Could not cache the tokenized {filename}: {err}")
+
+	data 			= list(zip(sents, labels, token_ids, attention_mask))
 
 	if flag =='train':
 		return data, len(num_labels)	
@@ -147,6 +246,11 @@ def get_args():
 	parser.add_argument("--cuda",				type=str,   	default= 	'1')
 	parser.add_argument("--dev_out", 			type=str, 	default=	"sst-dev-output.txt")
 	parser.add_argument("--test_out", 			type=str, 	default=	"sst-test-output.txt")
+	parser.add_argument("--compile", 			action='store_true')
+	parser.add_argument("--num_workers", 			type=int, 	default= 	4)
+	parser.add_argument("--train_eval_frac", 		type=float, 	default= 	0.1)
+	parser.add_argument("--grad_checkpoint", 		action='store_true')
+	parser.add_argument("--deterministic", 		action='store_true')
 	
 
 
@@ -156,48 +260,52 @@ def get_args():
 
 
 # perform model evaluation in terms of the accuracy and f1 score.
-def model_eval(dataloader, model, args, save_file=None):
+def model_eval(dataloader, model, args, save_file=None, use_bf16=False):
 	model.eval()
 	y_true=[]
 	y_pred=[]
 	sents =[]
+	indices =[]
 	use_cuda = int(args.cuda)>= 0
 
 	for step, batch in enumerate(dataloader):
-		b_ids, b_type_ids, b_mask, b_labels, b_sents  =  batch[0]['token_ids'], batch[0]['token_type_ids'], batch[0]['attention_mask'], batch[0]['labels'], batch[0]['sents']	
+		b_ids, b_type_ids, b_mask, b_labels, b_sents  =  batch['token_ids'], batch['token_type_ids'], batch['attention_mask'], batch['labels'], batch['sents']	
 
 		if use_cuda:
-			b_ids 							= 	b_ids.cuda()
-			b_type_ids						= 	b_type_ids.cuda()
-			b_mask 							= 	b_mask.cuda()
-			model.cuda()
+			b_ids 							= 	b_ids.cuda(non_blocking=True)
+			b_type_ids						= 	b_type_ids.cuda(non_blocking=True)
+			b_mask 							= 	b_mask.cuda(non_blocking=True)
 			
-		with torch.no_grad():
+		with torch.no_grad(), autocast(use_bf16):
 			logits 							= 	model(b_ids, b_type_ids, b_mask)
-			logits 							= 	logits.detach().cpu().numpy()
-			preds  							= 	np.argmax(logits, axis=1).flatten()
-			b_labels 						= 	b_labels.flatten()
-			y_true.extend(b_labels)
-			y_pred.extend(preds)
+			# keep the predictions on device, they are copied back once after the loop
+			y_pred.append(logits.argmax(dim=1))
+			y_true.append(b_labels.flatten())
 			sents.extend(b_sents)
+			indices.extend(batch['indices'])
 
+	y_true 	= torch.cat(y_true).numpy()
+	y_pred 	= torch.cat(y_pred).cpu().numpy()
 	f1 	= f1_score(y_true, y_pred, average='macro')
 	acc 	= accuracy_score(y_true, y_pred)
 
 	if save_file is not None:
 		out_fp = open(save_file, 'w')
-		for sent, pred in zip(sents, preds):
-			out_fp.write(f"{pred} ||| {sent}\n")
+		# the batches are sorted by length, write the predictions back in the original file order
+		for i in np.argsort(indices):
+			out_fp.write(f"{y_pred[i]} ||| {sents[i]}\n")
 		out_fp.close()
 
 	return acc, f1
 
 
 if __name__ == "__main__":
+	# only in the main process, so that spawned DataLoader workers do not open their own runs
+	wandb.init(project="minbert-assignment")
 	args = get_args()
 	wandb.config.update(args)
 
-	seed_everything(args.seed)	# fix the seed for reproducibility
+	seed_everything(args.seed, args.deterministic)	# fix the seed for reproducibility
 
 	# create the data and its corresponding datasets and dataloader
 	train_data, num_labels 				= create_data(args.train, 	'train')
@@ -207,10 +315,28 @@ if __name__ == "__main__":
 	train_dataset   				= BertDataset(train_data, args)
 	dev_dataset   					= BertDataset(dev_data, args)
 	test_dataset   					= BertDataset(test_data, args)
-	
-	train_dataloader 				= DataLoader(train_dataset, 	shuffle = True,  batch_size= args.batch_size, collate_fn= train_dataset.collate_fn)
-	dev_dataloader 					= DataLoader(dev_dataset, 	 	shuffle = False, batch_size= args.batch_size, collate_fn= dev_dataset.collate_fn)
-	test_dataloader 				= DataLoader(test_dataset, 	 	shuffle = False, batch_size= args.batch_size, collate_fn= test_dataset.collate_fn)
+	# train accuracy is reported on a fixed random subset rather than a full pass over the training set
+	# at least one example, so that model_eval never gets an empty loader
+	train_eval_size 				= min(len(train_data), max(1, int(np.ceil(len(train_data) * args.train_eval_frac))))
+	train_eval_data 				= random.sample(train_data, train_eval_size)
+	train_eval_dataset 				= BertDataset(train_eval_data, args)
+
+	# collate the training batches in background workers and pin them for asynchronous host-to-device copies
+	# the evaluation loaders are only iterated once per epoch and stay in the main process
+	train_loader_kwargs 			= {'num_workers': args.num_workers, 'pin_memory': int(args.cuda) >= 0}
+	if args.num_workers > 0:
+		train_loader_kwargs.update(persistent_workers= True, prefetch_factor= 4)
+
+	# batch sentences of similar length together so that little padding is needed
+	train_sampler 					= LengthGroupedBatchSampler(train_dataset.lengths, 	args.batch_size, shuffle = True)
+	dev_sampler 					= LengthGroupedBatchSampler(dev_dataset.lengths, 	args.batch_size, shuffle = False)
+	test_sampler 					= LengthGroupedBatchSampler(test_dataset.lengths, 	args.batch_size, shuffle = False)
+	train_eval_sampler 				= LengthGroupedBatchSampler(train_eval_dataset.lengths, args.batch_size, shuffle = False)
+
+	train_dataloader 				= DataLoader(train_dataset, 	batch_sampler= train_sampler,	collate_fn= train_dataset.collate_fn,	**train_loader_kwargs)
+	dev_dataloader 					= DataLoader(dev_dataset, 	 	batch_sampler= dev_sampler,		collate_fn= dev_dataset.collate_fn)
+	test_dataloader 				= DataLoader(test_dataset, 	 	batch_sampler= test_sampler,	collate_fn= test_dataset.collate_fn)
+	train_eval_dataloader 			= DataLoader(train_eval_dataset, batch_sampler= train_eval_sampler, collate_fn= train_eval_dataset.collate_fn)
 
 	# you can customize the config file that you want to provide to the Sentence classifier model
 	config 		 				= 	{'hidden_dropout_prob':0.3, 'num_labels': num_labels, 'hidden_size':768, 'data_dir':'.', 'option': args.option}
@@ -221,6 +347,8 @@ if __name__ == "__main__":
 
 		# initialize the Senetence Classification Model
 		model 						 	= BertSentClassifier(config)
+		# trade recomputation for activation memory to fit larger batches
+		model.bert.config.gradient_checkpointing 	= args.grad_checkpoint
 		wandb.watch(model)
 		
 		print("Loading Done")
@@ -231,6 +359,12 @@ if __name__ == "__main__":
 			use_cuda = True
 			os.environ['CUDA_VISIBLE_DEVICES'] = args.cuda
 			model.cuda()
+		use_bf16 						= 	use_native_bf16(use_cuda)
+
+		# fuse the pointwise ops and capture cuda graphs, `model` itself stays uncompiled for saving
+		compiled_model 					= 	model
+		if args.compile:
+			compiled_model 				= 	torch.compile(model, mode='reduce-overhead')
 
 		## Specify the option for pretraining or finetuning
 		
@@ -238,7 +372,6 @@ if __name__ == "__main__":
 
 		## specify the optimizer 
 		optimizer   			=	AdamW(model.parameters(), lr = lr)
-		best_model			= 	None
 		best_dev_acc			= 	0
 		filepath 			= 	f'{args.option}-{args.epochs}-{lr}.pt'
 		## run for the specified number of epochs
@@ -249,17 +382,19 @@ if __name__ == "__main__":
 			num_batches 	= 	0
 
 			for step, batch in enumerate(train_dataloader):
-				b_ids, b_type_ids, b_mask, b_labels, b_sents    =  batch[0]['token_ids'], batch[0]['token_type_ids'], batch[0]['attention_mask'], batch[0]['labels'], batch[0]['sents']	
+				b_ids, b_type_ids, b_mask, b_labels, b_sents    =  batch['token_ids'], batch['token_type_ids'], batch['attention_mask'], batch['labels'], batch['sents']	
 
 				if use_cuda:
-					b_ids 					= b_ids.cuda()
-					b_type_ids				= b_type_ids.cuda()
-					b_mask 					= b_mask.cuda()
-					b_labels				= b_labels.cuda()
+					b_ids 					= b_ids.cuda(non_blocking=True)
+					b_type_ids				= b_type_ids.cuda(non_blocking=True)
+					b_mask 					= b_mask.cuda(non_blocking=True)
+					b_labels				= b_labels.cuda(non_blocking=True)
 	    
 				optimizer.zero_grad()
-				logits 			=  	model(b_ids, b_type_ids, b_mask)
-				loss   			=  	F.nll_loss(logits, b_labels.view(-1), reduction='sum')/args.batch_size
+				with autocast(use_bf16):
+					logits 		=  	compiled_model(b_ids, b_type_ids, b_mask)
+					# inside autocast, cross_entropy is upcast to fp32
+					loss 		=  	F.cross_entropy(logits, b_labels.view(-1), reduction='mean')
 
 				loss.backward()
 				optimizer.step()
@@ -269,15 +404,15 @@ if __name__ == "__main__":
 				num_batches		+= 	1
 
 			train_loss 			= 	train_loss/(num_batches)
-			model.eval()
 			
-			train_acc, train_f1 		=  	model_eval(train_dataloader, 	model,	args)
-			dev_acc,   dev_f1 		= 	model_eval(dev_dataloader, 		model,	args)
+			# model_eval switches the model to eval mode, it goes back to train mode at the next epoch
+			train_acc, train_f1 		=  	model_eval(train_eval_dataloader, compiled_model, args, use_bf16=use_bf16)
+			dev_acc,   dev_f1 		= 	model_eval(dev_dataloader, 		compiled_model,	args, use_bf16=use_bf16)
 
 			if dev_acc > best_dev_acc:
 				best_dev_acc 		= 	dev_acc
-				best_model 	 	=	model
-				torch.save(best_model, filepath)
+				# only the parameters, the pretrained BERT code and config are not pickled
+				torch.save({'model': model.state_dict(), 'config': vars(config)}, filepath)
 
 			wandb.log({"Train Loss": loss.item(),
 						"Train Acc": train_acc,
@@ -287,19 +422,27 @@ if __name__ == "__main__":
 					})
 			print(f"Epoch {epoch} \t Train loss :: {round(train_loss, 3)} \t Train Acc :: {round(train_acc,3)} \t Dev Acc :: {round(dev_acc, 3)}")
 
-		model 					= 	torch.load(filepath)
+		# the checkpoint only holds tensors and plain config values, no pickled code
+		model.load_state_dict(torch.load(filepath, map_location='cpu', weights_only=True)['model'])
 
 	elif args.option == 'pretrain':
 		with open('weights.pkl','rb') as handle:
 			weights = pickle.load(handle)	
 		model 					=	PretrainedBert(config, weights)
-		
+
+		# the frozen model is only used for inference, run its linear layers in int8 on cpu
+		if int(args.cuda) < 0:
+			model 				=	torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+		else:
+			model.cuda()
+		use_bf16 				= 	use_native_bf16(int(args.cuda) >= 0)
+
 	else:
 		raise("Use pretrain or finetune mode!")
 
 
-	dev_acc, dev_f1			= model_eval(dev_dataloader, 		model,	args, save_file=args.dev_out)
-	test_acc, test_f1		= model_eval(test_dataloader, 		model,	args, save_file=args.test_out)
+	dev_acc, dev_f1			= model_eval(dev_dataloader, 		model,	args, save_file=args.dev_out, use_bf16=use_bf16)
+	test_acc, test_f1		= model_eval(test_dataloader, 		model,	args, save_file=args.test_out, use_bf16=use_bf16)
 
 	print(f"For seed {args.seed}\t  Dev acc :: {dev_acc}\t Test acc :: {test_acc}")
 